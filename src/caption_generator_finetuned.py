@@ -4,14 +4,22 @@ Works around the new torch>=2.6 restriction in transformers
 """
 
 import os
+import csv
+import json
+import hashlib
+import functools
 import torch
 import warnings
 import transformers
 transformers.utils.import_utils._torch_load_is_safe = lambda: True
 from transformers import BlipProcessor, BlipForConditionalGeneration
+from torch.utils.data import Dataset, DataLoader
+from torch.nn.utils import prune
+from torch.utils._triton import has_triton
 from PIL import Image
 import pandas as pd
 import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 # --------------------------------------------------
 # Safety patch for torch<2.6
@@ -28,108 +36,358 @@ IMG_DIR = "../data/images"
 ATTR_PATH = "../data/list_attr_celeba.csv"
 OUTPUT_CAPTION_FILE = "../data/captions/fine_tuned_criminal_captions.csv"
 MODEL_SAVE_PATH = "../models/caption_model/"
+CACHE_JSON = "../data/captions/blip_caption_cache.json"
+EMBED_CACHE_DIR = "../data/captions/blip_image_embeds/"
 
 # --------------------------------------------------
-# Model loading
+# Generation settings
 # --------------------------------------------------
+BATCH_SIZE = 16   # images per model.generate call
+NUM_BEAMS = 3
+MAX_LENGTH = 30
+NUM_WORKERS = max(1, (os.cpu_count() or 2) // 2)   # CPU decode/preprocess workers
+PREFETCH_FACTOR = 4   # batches queued ahead per worker
+IMAGE_SIZE = 384   # fixed processor output so compiled graphs are reused
+COMPILE_VISION = True   # torch.compile the ViT encoder on CUDA (needs Triton)
+CACHE_SAVE_EVERY = 1000   # persist the caption cache every N new captions
+HASH_WORKERS = 32   # threads for hashing image files
+CPU_QUANTIZE = True   # int8 dynamic quantization of nn.Linear on the CPU fallback
+CPU_PRUNE_AMOUNT = 0.0   # L1 unstructured pruning before quantizing (e.g. 0.3); may change captions
+CACHE_IMAGE_EMBEDS = False   # keep ViT outputs on disk (~0.9 MB per image in FP16)
+
 warnings.filterwarnings("ignore")
 
-print("🔹 Loading BLIP processor and model ...")
-processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
 
-# ---- Safe model loading workaround ----
-try:
-    model = BlipForConditionalGeneration.from_pretrained(
-        "Salesforce/blip-image-captioning-base"
-    )
-except ValueError as e:
-    print(f"⚠️ Caught transformer safety error: {e}")
-    print("👉 Retrying model load with local cache bypass ...")
-    model = BlipForConditionalGeneration.from_pretrained(
-        "Salesforce/blip-image-captioning-base",
-        local_files_only=False,
-        ignore_mismatched_sizes=True,
-    )
+# --------------------------------------------------
+# Dataset: decode + preprocess images in DataLoader workers
+# --------------------------------------------------
+class CelebDataset(Dataset):
+    def __init__(self, img_dir, img_names, processor):
+        self.img_dir = img_dir
+        self.img_names = img_names
+        self.processor = processor
+
+    def __len__(self):
+        return len(self.img_names)
+
+    def __getitem__(self, idx):
+        img_name = self.img_names[idx]
+        image = Image.open(os.path.join(self.img_dir, img_name))
+        # Let libjpeg decode at a reduced DCT scale that still covers IMAGE_SIZE
+        # (no-op for PNGs and for images already smaller than that)
+        image.draft("RGB", (IMAGE_SIZE, IMAGE_SIZE))
+        image = image.convert("RGB")
+        pixel_values = self.processor(
+            images=image,
+            size={"height": IMAGE_SIZE, "width": IMAGE_SIZE},
+            return_tensors="pt",
+        ).pixel_values
+        return {"image": img_name, "pixel_values": pixel_values.squeeze(0)}
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model.to(device)
-print(f"✅ Model ready on {device.upper()}")
 
 # --------------------------------------------------
-# Helper: make caption in criminal-style language
+# Caption cache: file hash + model + decoding settings -> BLIP caption
 # --------------------------------------------------
-def make_criminal_style_caption(base_caption, attributes):
-    gender = "male" if "Male" in attributes else "female"
-    emotion = "neutral expression"
-    if "Smiling" in attributes:
-        emotion = "smiling expression"
-    if "Angry" in attributes:
-        emotion = "angry look"
-    if "Sad" in attributes:
-        emotion = "sad face"
-    if "Surprised" in attributes:
-        emotion = "surprised expression"
-
-    hair = "short hair"
-    if "Bald" in attributes:
-        hair = "bald head"
-    elif "Black_Hair" in attributes:
-        hair = "black hair"
-    elif "Blond_Hair" in attributes:
-        hair = "blond hair"
-    elif "Brown_Hair" in attributes:
-        hair = "brown hair"
-    elif "Gray_Hair" in attributes:
-        hair = "gray hair"
-
-    beard = "no beard"
-    if "Beard" in attributes or "Goatee" in attributes:
-        beard = "with facial hair"
+def file_digest(img_path):
+    with open(img_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def caption_key(digest, tag):
+    # Decoding settings and model precision/pruning change the output
+    return f"{digest}:{tag}:{NUM_BEAMS}:{MAX_LENGTH}"
+
+
+def model_tag(device):
+    # Weights differ per device/precision (and pruning), and so do their outputs
+    if device == "cuda":
+        tag = "fp16"
+    else:
+        tag = "int8" if CPU_QUANTIZE else "fp32"
+        if CPU_PRUNE_AMOUNT:
+            tag += f"-prune{CPU_PRUNE_AMOUNT}"
+    return tag
+
+
+def embed_path(digest, tag):
+    # ViT outputs don't depend on decoding settings, only on the image and model
+    return os.path.join(EMBED_CACHE_DIR, f"{digest}.{tag}.pt")
+
+
+def save_embeds(embeds, path):
+    # Same temp-file + swap as save_cache, so a crash never leaves a torn .pt
+    tmp_path = path + ".tmp"
+    torch.save(embeds, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_cache():
+    if os.path.exists(CACHE_JSON):
+        with open(CACHE_JSON, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def save_cache(cache):
+    # Write to a temp file and swap it in so a crash never leaves a torn cache
+    os.makedirs(os.path.dirname(CACHE_JSON), exist_ok=True)
+    tmp_path = CACHE_JSON + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, CACHE_JSON)
 
-    return f"A {gender} suspect with {hair}, {beard}, and a {emotion}."
 
 # --------------------------------------------------
-# Load attributes if available
+# Text decoding from precomputed ViT outputs
 # --------------------------------------------------
-if os.path.exists(ATTR_PATH):
-    attr_df = pd.read_csv(ATTR_PATH)
-else:
-    attr_df = pd.DataFrame(columns=["image_id", "attributes"])
+def generate_from_embeds(model, image_embeds, **generate_kwargs):
+    """Same as BlipForConditionalGeneration.generate, minus the vision_model pass"""
+    text_config = model.config.text_config
+    image_attention_mask = torch.ones(
+        image_embeds.shape[:-1], dtype=torch.long, device=image_embeds.device
+    )
+    input_ids = torch.full(
+        (image_embeds.shape[0], 1), text_config.bos_token_id,
+        dtype=torch.long, device=image_embeds.device,
+    )
+    return model.text_decoder.generate(
+        input_ids=input_ids,
+        eos_token_id=text_config.sep_token_id,
+        pad_token_id=text_config.pad_token_id,
+        encoder_hidden_states=image_embeds,
+        encoder_attention_mask=image_attention_mask,
+        # KV cache is reused across decoding steps within a batch. It can't be
+        # shared across images: the only prompt is BOS and every decoder layer
+        # cross-attends to the image, so even the prefix states are per-image.
+        use_cache=True,
+        **generate_kwargs,
+    )
+
 
 # --------------------------------------------------
-# Generate captions
+# Helper: make caption in criminal-style language
 # --------------------------------------------------
-captions = []
+# (attribute, phrase) pairs checked in priority order; first match wins
+EMOTION_MAP = (
+    ("Surprised", "surprised expression"),
+    ("Sad", "sad face"),
+    ("Angry", "angry look"),
+    ("Smiling", "smiling expression"),
+)
+HAIR_MAP = (
+    ("Bald", "bald head"),
+    ("Black_Hair", "black hair"),
+    ("Blond_Hair", "blond hair"),
+    ("Brown_Hair", "brown hair"),
+    ("Gray_Hair", "gray hair"),
+)
+FACIAL_HAIR = frozenset(("Beard", "Goatee"))
 
-print("🖼️ Generating captions ...")
-for img_name in tqdm.tqdm(os.listdir(IMG_DIR)):
-    if not img_name.lower().endswith((".jpg", ".png")):
-        continue
 
-    img_path = os.path.join(IMG_DIR, img_name)
-    image = Image.open(img_path).convert("RGB")
+@functools.lru_cache(maxsize=65536)
+def _criminal_style(attrs):
+    # Many CelebA rows share an attribute set, so most calls are cache hits
+    gender = "male" if "Male" in attrs else "female"
+    emotion = next((v for k, v in EMOTION_MAP if k in attrs), "neutral expression")
+    hair = next((v for k, v in HAIR_MAP if k in attrs), "short hair")
+    beard = "with facial hair" if attrs & FACIAL_HAIR else "no beard"
 
-    inputs = processor(image, return_tensors="pt").to(device)
-    output = model.generate(**inputs)
-    base_caption = processor.decode(output[0], skip_special_tokens=True)
+    return f"A {gender} suspect with {hair}, {beard}, and a {emotion}."
+
+
+def make_criminal_style_caption(base_caption, attributes):
+    return _criminal_style(frozenset(attributes))
+
+
+def main():
+    # --------------------------------------------------
+    # Model loading
+    # --------------------------------------------------
+    print("🔹 Loading BLIP processor and model ...")
+    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
+
+    # ---- Safe model loading workaround ----
+    try:
+        model = BlipForConditionalGeneration.from_pretrained(
+            "Salesforce/blip-image-captioning-base"
+        )
+    except ValueError as e:
+        print(f"⚠️ Caught transformer safety error: {e}")
+        print("👉 Retrying model load with local cache bypass ...")
+        model = BlipForConditionalGeneration.from_pretrained(
+            "Salesforce/blip-image-captioning-base",
+            local_files_only=False,
+            ignore_mismatched_sizes=True,
+        )
 
-    if not attr_df.empty and img_name in attr_df["image_id"].values:
-        row = attr_df[attr_df["image_id"] == img_name].iloc[0]
-        attributes = [attr for attr, val in row.items() if val == 1]
+    # Save the unmodified FP32 weights before any inference-only conversion
+    os.makedirs(MODEL_SAVE_PATH, exist_ok=True)
+    model.save_pretrained(MODEL_SAVE_PATH)
+    processor.save_pretrained(MODEL_SAVE_PATH)
+    print(f"✅ Model + processor saved at: {MODEL_SAVE_PATH}")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # Inductor needs Triton for CUDA kernels; stock Windows torch wheels ship without it
+    compiled = device == "cuda" and COMPILE_VISION and has_triton()
+    model.to(device)
+    model.eval()
+    if device == "cuda":
+        # TF32 tensor-core kernels for any matmul/conv still running in FP32
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+        # FP16 halves weight bytes on the bandwidth-bound transformer layers
+        model = model.half()
+        # NHWC layout for the ViT patch-embedding conv
+        model = model.to(memory_format=torch.channels_last)
+        # Compile the ViT encoder: its input shape is fixed, so CUDA graphs are
+        # captured once. The text decoder is left eager since its sequence
+        # length changes every decoding step.
+        if compiled:
+            model.vision_model = torch.compile(
+                model.vision_model, mode="reduce-overhead", fullgraph=False
+            )
+        else:
+            print("⚠️ Triton not available (or COMPILE_VISION off), running ViT eagerly")
     else:
-        attributes = []
+        if CPU_PRUNE_AMOUNT:
+            for module in model.modules():
+                if isinstance(module, torch.nn.Linear):
+                    prune.l1_unstructured(module, "weight", amount=CPU_PRUNE_AMOUNT)
+                    prune.remove(module, "weight")
+        if CPU_QUANTIZE:
+            # int8 dynamic quantization of nn.Linear for the CPU fallback
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+    tag = model_tag(device)
+    print(f"✅ Model ready on {device.upper()}")
 
-    fine_caption = make_criminal_style_caption(base_caption, attributes)
-    captions.append({"image": img_name, "caption": fine_caption})
+    # --------------------------------------------------
+    # Load attributes if available
+    # --------------------------------------------------
+    if os.path.exists(ATTR_PATH):
+        attr_df = pd.read_csv(ATTR_PATH)
+    else:
+        attr_df = pd.DataFrame(columns=["image_id", "attributes"])
 
-# --------------------------------------------------
-# Save outputs
-# --------------------------------------------------
-os.makedirs(os.path.dirname(OUTPUT_CAPTION_FILE), exist_ok=True)
-pd.DataFrame(captions).to_csv(OUTPUT_CAPTION_FILE, index=False)
-print(f"✅ Captions saved at: {OUTPUT_CAPTION_FILE}")
-
-os.makedirs(MODEL_SAVE_PATH, exist_ok=True)
-model.save_pretrained(MODEL_SAVE_PATH)
-processor.save_pretrained(MODEL_SAVE_PATH)
-print(f"✅ Model + processor saved at: {MODEL_SAVE_PATH}")
+    # image_id -> set of positive attributes, built once for O(1) lookups
+    attr_df = attr_df.set_index("image_id")
+    attr_dict = {
+        row[0]: frozenset(attr for attr, val in zip(attr_df.columns, row[1:]) if val == 1)
+        for row in attr_df.itertuples()
+    }
+
+    # --------------------------------------------------
+    # Generate captions
+    # --------------------------------------------------
+    with os.scandir(IMG_DIR) as it:
+        img_entries = [
+            e for e in it
+            if e.name.lower().endswith((".jpg", ".png")) and e.is_file()
+        ]
+    img_names = [e.name for e in img_entries]
+
+    # Reuse captions from previous runs; only uncached images go through BLIP
+    cache = load_cache()
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as ex:
+        digests = dict(zip(img_names, ex.map(
+            file_digest, [e.path for e in img_entries]
+        )))
+
+    # Rows are streamed to the CSV batch by batch: memory stays O(batch) and a
+    # crash keeps everything written so far (reruns resume via the cache)
+    os.makedirs(os.path.dirname(OUTPUT_CAPTION_FILE), exist_ok=True)
+    with open(OUTPUT_CAPTION_FILE, "w", newline="", encoding="utf-8",
+              buffering=1 << 20) as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(("image", "caption"))
+
+        pending = []
+        n_cached = 0
+        for img_name in img_names:
+            key = caption_key(digests[img_name], tag)
+            if key in cache:
+                fine_caption = make_criminal_style_caption(
+                    cache[key], attr_dict.get(img_name, frozenset())
+                )
+                writer.writerow((img_name, fine_caption))
+                n_cached += 1
+            else:
+                pending.append(img_name)
+        print(f"♻️ {n_cached} cached captions, {len(pending)} to generate")
+
+        # CPU workers decode/preprocess the next batches while the GPU generates
+        loader = DataLoader(
+            CelebDataset(IMG_DIR, pending, processor),
+            batch_size=BATCH_SIZE,
+            num_workers=NUM_WORKERS,
+            pin_memory=(device == "cuda"),
+            persistent_workers=True,
+            prefetch_factor=PREFETCH_FACTOR,
+        )
+
+        if CACHE_IMAGE_EMBEDS:
+            os.makedirs(EMBED_CACHE_DIR, exist_ok=True)
+
+        new_since_save = 0
+        with torch.inference_mode():
+            if compiled and pending:
+                # Warm-up batch triggers compilation before the timed loop
+                print("🔥 Compiling model (warm-up batch) ...")
+                dummy = torch.zeros(
+                    BATCH_SIZE, 3, IMAGE_SIZE, IMAGE_SIZE, dtype=torch.float16, device=device
+                ).contiguous(memory_format=torch.channels_last)
+                model.vision_model(pixel_values=dummy)
+
+            print("🖼️ Generating captions ...")
+            for batch in tqdm.tqdm(loader):
+                n_images = len(batch["image"])
+                paths = [embed_path(digests[name], tag) for name in batch["image"]]
+
+                if CACHE_IMAGE_EMBEDS and all(os.path.exists(p) for p in paths):
+                    # ViT already ran for these images on a previous run
+                    image_embeds = torch.stack([torch.load(p) for p in paths]).to(device)
+                else:
+                    pixel_values = batch["pixel_values"].to(device, non_blocking=True)
+                    if device == "cuda":
+                        pixel_values = pixel_values.half()
+                        # Pad the last batch to BATCH_SIZE to avoid a recompile
+                        if compiled and n_images < BATCH_SIZE:
+                            pad = pixel_values.new_zeros(
+                                (BATCH_SIZE - n_images, *pixel_values.shape[1:])
+                            )
+                            pixel_values = torch.cat([pixel_values, pad])
+                        pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
+                    image_embeds = model.vision_model(pixel_values=pixel_values)[0][:n_images]
+                    if CACHE_IMAGE_EMBEDS:
+                        for p, embeds in zip(paths, image_embeds.cpu()):
+                            save_embeds(embeds.clone(), p)
+
+                output = generate_from_embeds(
+                    model, image_embeds, num_beams=NUM_BEAMS, max_length=MAX_LENGTH
+                )
+                base_captions = processor.batch_decode(output, skip_special_tokens=True)
+
+                batch_rows = []
+                for img_name, base_caption in zip(batch["image"], base_captions):
+                    cache[caption_key(digests[img_name], tag)] = base_caption
+                    attributes = attr_dict.get(img_name, frozenset())
+                    fine_caption = make_criminal_style_caption(base_caption, attributes)
+                    batch_rows.append((img_name, fine_caption))
+                writer.writerows(batch_rows)
+                out_file.flush()
+
+                new_since_save += n_images
+                if new_since_save >= CACHE_SAVE_EVERY:
+                    save_cache(cache)
+                    new_since_save = 0
+
+        if new_since_save:
+            save_cache(cache)
+
+    print(f"✅ Captions saved at: {OUTPUT_CAPTION_FILE}")
+
+
+if __name__ == '__main__':
+    main()
@@ -10,53 +10,86 @@ Time: 10-15 minutes
 import os
 import re
 from pathlib import Path
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import pandas as pd
 
+from file_utils import READ_WORKERS, WRITE_WORKERS, emit_pair
+
 # ===== CONFIGURATION =====
 TEXT_DIR = "../data/text"  # Your caption folder
 IMAGE_DIR = "../data/images"
 OUTPUT_TRAIN_DIR = "../data/processed/train"
 OUTPUT_CSV = "../data/captions/final_captions.csv"
 MAX_CAPTION_WORDS = 30  # Max words per caption
+CSV_CHUNKSIZE = 50000  # Rows per to_csv write chunk
+IMAGE_EXTS = ['.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG']  # In priority order
 # =========================
 
-def clean_caption(caption):
-    """Clean and shorten verbose CelebA caption"""
+# Redundant lead-in phrases, merged into one alternation and compiled once
+_PHRASE_RE = re.compile(
+    r'(?:This|The) (?:person|woman|man|individual|girl|boy) (?:is|has)'
+    r'|(?:She|He) (?:is|has|wears)',
+    re.IGNORECASE,
+)
+_WS_RE = re.compile(r'\s+')
+_COMMA_RE = re.compile(r',\s*,+')
+
+
+def clean_captions(captions):
+    """Clean and shorten a Series of verbose CelebA captions (vectorized)"""
     
     # Remove redundant phrases
-    caption = re.sub(r'This (person|woman|man|individual|girl|boy) (is|has)', '', caption, flags=re.IGNORECASE)
-    caption = re.sub(r'The (person|woman|man|individual|girl|boy) (is|has)', '', caption, flags=re.IGNORECASE)
-    caption = re.sub(r'She (is|has|wears)', '', caption, flags=re.IGNORECASE)
-    caption = re.sub(r'He (is|has|wears)', '', caption, flags=re.IGNORECASE)
+    captions = captions.str.replace(_PHRASE_RE, '', regex=True)
     
     # Combine multiple sentences into one
-    caption = caption.replace('. ', ', ')
-    caption = caption.replace('..', '.')
+    captions = captions.str.replace('. ', ', ', regex=False)
+    captions = captions.str.replace('..', '.', regex=False)
     
     # Remove multiple spaces
-    caption = re.sub(r'\s+', ' ', caption)
+    captions = captions.str.replace(_WS_RE, ' ', regex=True)
     
     # Remove multiple commas
-    caption = re.sub(r',\s*,+', ',', caption)
+    captions = captions.str.replace(_COMMA_RE, ',', regex=True)
     
     # Remove leading/trailing punctuation
-    caption = caption.strip(' .,')
+    captions = captions.str.strip(' .,')
     
     # Limit to MAX_CAPTION_WORDS words
-    words = caption.split()
-    if len(words) > MAX_CAPTION_WORDS:
-        caption = ' '.join(words[:MAX_CAPTION_WORDS])
+    captions = captions.str.split().str[:MAX_CAPTION_WORDS].str.join(' ')
     
     # Ensure starts with capital
-    if caption:
-        caption = caption[0].upper() + caption[1:]
+    captions = captions.str[:1].str.upper() + captions.str[1:]
     
     # Clean up and add period
-    caption = caption.rstrip(',').strip() + '.'
+    captions = captions.str.rstrip(',').str.strip() + '.'
     
-    return caption
+    return captions
+
+
+def _read_utf8(filepath):
+    """Read a caption file, returning None if it can't be read"""
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except Exception:
+        return None
+
+
+def index_images(image_dir):
+    """Map image stem -> path in one directory scan (first extension in IMAGE_EXTS wins)"""
+    rank = {ext: i for i, ext in enumerate(IMAGE_EXTS)}
+    entries = []
+    with os.scandir(image_dir) as it:
+        for e in it:
+            stem, ext = os.path.splitext(e.name)
+            if ext in rank and e.is_file():
+                entries.append((rank[ext], stem, e.path))
+    
+    image_by_stem = {}
+    for _, stem, path in sorted(entries):
+        image_by_stem.setdefault(stem, Path(path))
+    return image_by_stem
 
 
 def main():
@@ -76,7 +109,8 @@ def main():
         return
     
     # Get all caption files
-    caption_files = list(Path(TEXT_DIR).glob("*.txt"))
+    with os.scandir(TEXT_DIR) as it:
+        caption_files = [e.path for e in it if e.name.endswith('.txt') and e.is_file()]
     
     print(f"\n Found {len(caption_files)} caption files")
     
@@ -90,50 +124,37 @@ def main():
     
     print(f"\n Processing captions...")
     
-    for caption_file in tqdm(caption_files, desc="Processing"):
-        # Get image name
-        image_name = caption_file.stem
-        
+    image_by_stem = index_images(IMAGE_DIR)
+    pairs = []
+    
+    for caption_file in tqdm(caption_files, desc="Matching"):
         # Find image file
-        image_found = False
-        image_path = None
+        image_path = image_by_stem.get(Path(caption_file).stem)
         
-        for ext in ['.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG']:
-            potential_path = Path(IMAGE_DIR) / f"{image_name}{ext}"
-            if potential_path.exists():
-                image_found = True
-                image_path = potential_path
-                image_filename = f"{image_name}{ext}"
-                break
-        
-        if not image_found:
+        if image_path is None:
             skipped_count += 1
             continue
         
-        # Read caption
-        try:
-            with open(caption_file, 'r', encoding='utf-8') as f:
-                original_caption = f.read().strip()
-            
-            # Skip if empty
-            if len(original_caption) < 5:
-                skipped_count += 1
-                continue
-            
-            # Clean caption
-            cleaned_caption = clean_caption(original_caption)
-            
-            results.append({
-                'image_id': image_filename,
-                'original_caption': original_caption,
-                'cleaned_caption': cleaned_caption
-            })
-            
-            matched_count += 1
-        
-        except Exception as e:
+        pairs.append((image_path, caption_file))
+    
+    # Read captions in parallel
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as ex:
+        texts = list(tqdm(ex.map(_read_utf8, [c for _, c in pairs]),
+                          total=len(pairs), desc="Reading"))
+    
+    for (image_path, _), original_caption in zip(pairs, texts):
+        # Skip if unreadable or empty
+        if original_caption is None or len(original_caption) < 5:
             skipped_count += 1
             continue
+        
+        results.append({
+            'image_id': image_path.name,
+            'original_caption': original_caption,
+            'src_path': str(image_path)
+        })
+        
+        matched_count += 1
     
     print(f"\n Matched {matched_count} image-caption pairs")
     if skipped_count > 0:
@@ -144,8 +165,9 @@ def main():
         print("Check that image filenames match caption filenames")
         return
     
-    # Save to CSV
+    # Clean all captions in one vectorized pass
     df = pd.DataFrame(results)
+    df['cleaned_caption'] = clean_captions(df['original_caption'])
     
     # Show samples
     print("\n" + "="*80)
@@ -172,49 +194,26 @@ def main():
     # Save CSV
     print(f"\n Saving captions to CSV...")
     os.makedirs(os.path.dirname(OUTPUT_CSV), exist_ok=True)
-    df.to_csv(OUTPUT_CSV, index=False)
+    df.drop(columns=['src_path']).to_csv(OUTPUT_CSV, index=False, chunksize=CSV_CHUNKSIZE)
     print(f"    Saved to: {OUTPUT_CSV}")
     
     # Prepare training data
     print(f"\n Preparing training data...")
     os.makedirs(OUTPUT_TRAIN_DIR, exist_ok=True)
     
-    saved_count = 0
+    # Source images were already located during matching
+    records = [
+        (Path(src), Path(OUTPUT_TRAIN_DIR) / image_id, caption)
+        for src, image_id, caption in zip(df['src_path'], df['image_id'], df['cleaned_caption'])
+    ]
     
-    for idx, row in tqdm(df.iterrows(), total=len(df), desc="Copying images and captions"):
-        image_id = row['image_id']
-        caption = row['cleaned_caption']
-        
-        # Find source image
-        image_found = False
-        for ext in ['.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG']:
-            potential_path = Path(IMAGE_DIR) / f"{row['image_id'].split(chr(46))[0]}{ext}"
-            if potential_path.exists():
-                src_image = potential_path
-                image_found = True
-                break
-        
-        if not image_found:
-            src_image = Path(IMAGE_DIR) / image_id
-        
-        if src_image.exists():
-            # Copy/link image
-            dst_image = Path(OUTPUT_TRAIN_DIR) / image_id
-            
-            if not dst_image.exists():
-                try:
-                    os.symlink(src_image, dst_image)
-                except:
-                    shutil.copy2(src_image, dst_image)
-            
-            # Save caption
-            txt_file = dst_image.with_suffix('.txt')
-            with open(txt_file, 'w', encoding='utf-8') as f:
-                f.write(caption)
-            
-            saved_count += 1
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as ex:
+        saved_count = sum(tqdm(ex.map(emit_pair, records), total=len(records),
+                               desc="Linking images and captions"))
     
     print(f"\n Saved {saved_count} image-caption pairs to training directory!")
+    if saved_count < len(records):
+        print(f"  Failed to save {len(records) - saved_count} pairs")
     print(f"   Location: {OUTPUT_TRAIN_DIR}")
     print(f"   Format: image.jpg + image.txt")
     
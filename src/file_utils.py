@@ -0,0 +1,31 @@
+"""
+Shared file helpers for the caption preprocessing scripts
+(clean_and_prepare_captions.py and process_all_captions.py)
+"""
+
+import os
+import shutil
+
+READ_WORKERS = 32  # Threads for reading caption files (I/O bound)
+WRITE_WORKERS = 64  # Threads for linking images / writing caption files
+
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst, falling back to a copy (e.g. across filesystems)"""
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def emit_pair(record):
+    """Link one image into the output dir and write its caption; False on failure"""
+    src_image, dst_image, caption = record
+    try:
+        link_or_copy(src_image, dst_image)
+        dst_image.with_suffix('.txt').write_bytes(caption.encode('utf-8'))
+        return True
+    except Exception:
+        return False
@@ -8,11 +8,13 @@ Run: python process_all_captions.py
 """
 
 import os
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import re
 import sys
 
+from file_utils import READ_WORKERS, WRITE_WORKERS, emit_pair
+
 try:
     from tqdm import tqdm
     HAS_TQDM = True
@@ -41,10 +43,22 @@ def clean_caption(text):
 
 def find_caption_files(start_path):
     """Recursively find all .txt files"""
-    path = Path(start_path)
-    if not path.exists():
+    if not Path(start_path).exists():
         return []
-    return list(path.rglob("*.txt"))
+    files = []
+    stack = [start_path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith('.txt'):
+                        files.append(Path(entry.path))
+        except OSError:
+            # Skip unreadable directories, like Path.rglob did
+            continue
+    return files
 
 
 def find_image_files(img_dir):
@@ -60,17 +74,11 @@ def find_image_files(img_dir):
 
 def match_images_captions(captions, images):
     """Match caption files with image files by stem"""
-    matches = []
-    
-    for cap_file in captions:
-        cap_stem = cap_file.stem
-        
-        for img_file in images:
-            if img_file.stem == cap_stem:
-                matches.append((img_file, cap_file))
-                break
+    img_by_stem = {}
+    for img_file in images:
+        img_by_stem.setdefault(img_file.stem, img_file)
     
-    return matches
+    return [(img_by_stem[c.stem], c) for c in captions if c.stem in img_by_stem]
 
 
 def read_caption_file(filepath):
@@ -165,41 +173,32 @@ def main():
     success = 0
     failed = 0
     
-    iterator = tqdm(matches, desc="Processing") if HAS_TQDM else matches
+    # Read all caption files in parallel
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as ex:
+        texts = list(ex.map(read_caption_file, [cap for _, cap in matches]))
     
-    for img_file, cap_file in iterator:
-        try:
-            # Read caption
-            caption_text = read_caption_file(cap_file)
-            if not caption_text:
-                failed += 1
-                continue
-            
-            # Clean caption
-            caption_text = clean_caption(caption_text)
-            
-            # Copy image
-            dst_img = output_dir / img_file.name
-            if not dst_img.exists():
-                try:
-                    os.symlink(img_file, dst_img)
-                except:
-                    shutil.copy2(img_file, dst_img)
-            
-            # Write caption
-            txt_out = dst_img.with_suffix('.txt')
-            with open(txt_out, 'w', encoding='utf-8') as f:
-                f.write(caption_text)
-            
-            results.append({
-                'image_id': img_file.name,
-                'caption': caption_text
-            })
-            
-            success += 1
-        
-        except Exception as e:
+    records = []
+    for (img_file, _), caption_text in zip(matches, texts):
+        if not caption_text:
             failed += 1
+            continue
+        records.append((img_file, output_dir / img_file.name, clean_caption(caption_text)))
+    
+    # Link images and write captions in parallel
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as ex:
+        outputs = ex.map(emit_pair, records)
+        if HAS_TQDM:
+            outputs = tqdm(outputs, total=len(records), desc="Processing")
+        
+        for (img_file, _, caption_text), ok in zip(records, outputs):
+            if ok:
+                results.append({
+                    'image_id': img_file.name,
+                    'caption': caption_text
+                })
+                success += 1
+            else:
+                failed += 1
     
     # Step 6: Results
     print("\n" + "=" * 80)
@@ -7,13 +7,67 @@ Run: python validate_captions.py
 Time: 5 minutes
 """
 
+import numpy as np
 import pandas as pd
 import os
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+    print("Note: pyarrow not installed, using slower pandas string ops")
+
 # ===== CONFIGURATION =====
 CSV_FILE = "../data/captions/final_captions.csv"
+CHUNK_SIZE = 50000  # Rows read per chunk (pandas fallback)
+ARROW_BLOCK_SIZE = 1 << 24  # Bytes read per chunk (pyarrow)
+N_SAMPLES = 15  # Random captions shown for review
 # =========================
 
+def read_chunks(caption_col):
+    """Stream the CSV, yielding (chunk, char_lengths, word_counts) per chunk
+    
+    Missing captions match the old whole-DataFrame stats: they are left out of the
+    character stats (.str.len() skips NaN) but count as one word ("nan").
+    """
+    if HAS_PYARROW:
+        reader = pa_csv.open_csv(
+            CSV_FILE,
+            read_options=pa_csv.ReadOptions(block_size=ARROW_BLOCK_SIZE),
+            # Raw captions keep their line breaks inside quoted cells
+            parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=['image_id', caption_col],
+                column_types={'image_id': pa.string(), caption_col: pa.string()},
+                strings_can_be_null=True,  # empty fields are missing, as in pandas
+            ),
+        )
+        for batch in reader:
+            captions = batch.column(caption_col)
+            char_lengths = pc.utf8_length(captions.drop_null()).to_numpy()
+            # Trim first: utf8_split_whitespace yields empty tokens at the edges,
+            # and an all-whitespace caption must count as 0 words like str.split()
+            trimmed = pc.utf8_trim_whitespace(captions)
+            word_counts = pc.if_else(
+                pc.equal(trimmed, ''), 0,
+                pc.list_value_length(pc.utf8_split_whitespace(trimmed)),
+            )
+            word_counts = pc.fill_null(word_counts, 1).to_numpy()
+            yield batch.to_pandas(), char_lengths, word_counts
+    else:
+        reader = pd.read_csv(CSV_FILE, chunksize=CHUNK_SIZE, usecols=['image_id', caption_col])
+        for chunk in reader:
+            captions = chunk[caption_col]
+            word_counts = captions.astype(str).str.split().str.len()
+            # pandas < 3 turns NaN into "nan" (1 word); newer pandas keeps NaN
+            word_counts = word_counts.fillna(1).astype(int)
+            yield (chunk, captions.dropna().astype(str).str.len().to_numpy(),
+                   word_counts.to_numpy())
+
+
 def main():
     print("="*80)
     print("CAPTION QUALITY VALIDATION")
@@ -25,34 +79,79 @@ def main():
         print("\nRun process_all_captions.py first!")
         return
     
-    # Load captions
-    print(f"\n Loading captions from: {CSV_FILE}")
-    df = pd.read_csv(CSV_FILE)
-    print(f"    Loaded {len(df)} captions")
-    
-    # Detect column name
-    if 'cleaned_caption' in df.columns:
+    # Detect column name from the header only
+    columns = pd.read_csv(CSV_FILE, nrows=0).columns
+    if 'cleaned_caption' in columns:
         caption_col = 'cleaned_caption'
-    elif 'caption' in df.columns:
+    elif 'caption' in columns:
         caption_col = 'caption'
     else:
         print("\n ERROR: No valid caption column found in CSV!")
         print(" Expected one of: 'caption' or 'cleaned_caption'")
-        print(f" Columns found: {list(df.columns)}")
+        print(f" Columns found: {list(columns)}")
         return
-
-    # Sample 15 random captions
-    print("\n Sampling 15 random captions for review...")
-    samples = df.sample(n=min(15, len(df)), random_state=42)
+    
+    # Stream captions in chunks, keeping only running totals in memory
+    print(f"\n Loading captions from: {CSV_FILE}")
+    
+    total = 0
+    char_count, char_sum, char_min, char_max = 0, 0, float('inf'), float('-inf')
+    word_sum, word_min, word_max = 0, float('inf'), 0
+    ideal = 0
+    duplicates = 0
+    seen = set()  # captions seen so far (missing captions stored as None)
+    
+    # Random sample: keep the N_SAMPLES rows with the smallest random keys
+    rng = np.random.default_rng(42)
+    samples = None
+    
+    for chunk, char_lengths, word_counts in read_chunks(caption_col):
+        if len(chunk) == 0:
+            continue
+        
+        total += len(chunk)
+        if len(char_lengths):
+            char_count += len(char_lengths)
+            char_sum += int(char_lengths.sum())
+            char_min = min(char_min, int(char_lengths.min()))
+            char_max = max(char_max, int(char_lengths.max()))
+        word_sum += int(word_counts.sum())
+        word_min = min(word_min, int(word_counts.min()))
+        word_max = max(word_max, int(word_counts.max()))
+        ideal += int(((word_counts >= 10) & (word_counts <= 30)).sum())
+        
+        # Like duplicated(): exact string matches, and all missing captions are equal
+        for caption in chunk[caption_col]:
+            if pd.isna(caption):
+                caption = None
+            if caption in seen:
+                duplicates += 1
+            else:
+                seen.add(caption)
+        
+        chunk = chunk.assign(key=rng.random(len(chunk)))
+        if samples is not None:
+            chunk = pd.concat([samples, chunk])
+        samples = chunk.nsmallest(N_SAMPLES, 'key')
+    
+    print(f"    Loaded {total} captions")
+    
+    if total == 0:
+        print("\n ERROR: Caption file is empty!")
+        return
+    
+    # Sample random captions
+    print(f"\n Sampling {N_SAMPLES} random captions for review...")
     
     print("\n" + "="*80)
     print("CAPTION SAMPLES")
     print("="*80)
     
-    for i, (idx, row) in enumerate(samples.iterrows(), 1):
-        word_count = len(str(row[caption_col]).split())
-        print(f"\n{i}. Image: {row['image_id']}")
-        print(f"   Caption: {row[caption_col]}")
+    for i, (image_id, caption) in enumerate(
+            samples[['image_id', caption_col]].itertuples(index=False), 1):
+        word_count = len(str(caption).split())
+        print(f"\n{i}. Image: {image_id}")
+        print(f"   Caption: {caption}")
         print(f"   [{word_count} words]")
     
     # Statistics
@@ -60,23 +159,24 @@ def main():
     print("STATISTICS")
     print("="*80)
     
-    word_counts = df[caption_col].astype(str).str.split().str.len()
-    
-    print(f"\nTotal captions: {len(df)}")
+    print(f"\nTotal captions: {total}")
     print(f"\nCaption length (characters):")
-    print(f"  Avg: {df[caption_col].str.len().mean():.1f}")
-    print(f"  Min: {df[caption_col].str.len().min()}")
-    print(f"  Max: {df[caption_col].str.len().max()}")
+    if char_count:
+        print(f"  Avg: {char_sum/char_count:.1f}")
+        print(f"  Min: {char_min}")
+        print(f"  Max: {char_max}")
+    else:
+        print("  Avg: nan")
+        print("  Min: nan")
+        print("  Max: nan")
     print(f"\nWord count:")
-    print(f"  Avg: {word_counts.mean():.1f}")
-    print(f"  Min: {word_counts.min()}")
-    print(f"  Max: {word_counts.max()}")
-    print(f"  Ideal (10–30 words): {((word_counts >= 10) & (word_counts <= 30)).sum()} "
-          f"({((word_counts >= 10) & (word_counts <= 30)).sum()/len(df)*100:.1f}%)")
+    print(f"  Avg: {word_sum/total:.1f}")
+    print(f"  Min: {word_min}")
+    print(f"  Max: {word_max}")
+    print(f"  Ideal (10–30 words): {ideal} ({ideal/total*100:.1f}%)")
     
     # Check duplicates
-    duplicates = df[caption_col].duplicated().sum()
-    print(f"\nDuplicate captions: {duplicates} ({duplicates/len(df)*100:.2f}%)")
+    print(f"\nDuplicate captions: {duplicates} ({duplicates/total*100:.2f}%)")
     if duplicates < 10:
         print("   Good - very few duplicates!")
     
@@ -0,0 +1,63 @@
+"""
+Consistency check: validate_captions.read_chunks must give the same
+stats with the pyarrow reader and the pandas fallback.
+
+Run: python test.py   (or: python -m pytest test.py)
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+import validate_captions
+
+# Edge cases: padded / all-whitespace / missing / multi-line captions
+FIXTURE = '''image_id,caption
+1.jpg,"  lead  trail  "
+2.jpg," a"
+3.jpg,"   "
+4.jpg,
+5.jpg,"one two three"
+6.jpg,"multi
+line caption"
+'''
+
+
+def collect(caption_col):
+    char_lengths, word_counts = [], []
+    for _, chars, words in validate_captions.read_chunks(caption_col):
+        char_lengths.extend(chars.tolist())
+        word_counts.extend(words.tolist())
+    return char_lengths, word_counts
+
+
+def test_readers_agree():
+    if not validate_captions.HAS_PYARROW:
+        print("pyarrow not installed, nothing to compare")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "captions.csv")
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            f.write(FIXTURE)
+
+        old_csv = validate_captions.CSV_FILE
+        validate_captions.CSV_FILE = csv_path
+        try:
+            validate_captions.HAS_PYARROW = True
+            arrow_stats = collect("caption")
+            validate_captions.HAS_PYARROW = False
+            pandas_stats = collect("caption")
+        finally:
+            validate_captions.HAS_PYARROW = True
+            validate_captions.CSV_FILE = old_csv
+
+    assert arrow_stats == pandas_stats, (arrow_stats, pandas_stats)
+    # Missing caption: no char length, one word; all-whitespace: zero words
+    assert arrow_stats == ([15, 2, 3, 13, 18], [2, 1, 0, 1, 3, 3])
+
+
+if __name__ == '__main__':
+    test_readers_agree()
+    print("OK")